@@ -0,0 +1,8 @@
+import os
+
+# app.py lê o ambiente no import: valores de teste, sem cache do LLM em disco
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("N8N_BASE", "http://n8n.test/webhook")
+os.environ.setdefault("N8N_TOOL_TOKEN", "test")
+os.environ["LLM_CACHE"] = "0"
+os.environ["SEMANTIC_CACHE"] = "0"
@@ -0,0 +1,211 @@
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from langchain_core.messages import AIMessage, ToolMessage
+
+import app
+
+
+# ----------------------------
+# AsyncBatcher
+# ----------------------------
+def test_batcher_flush_por_tamanho(monkeypatch):
+    posts = []
+
+    async def fake_post(path, payload):
+        posts.append(payload["itens"])
+        return [{"texto": f"R$ {p['produto']}"} for p in payload["itens"]]
+
+    monkeypatch.setattr(app, "post_n8n", fake_post)
+
+    async def main():
+        # janela longa: só o tamanho pode disparar o POST
+        b = app.AsyncBatcher("preco-lote", window_s=60, max_batch=2)
+        return await asyncio.gather(b.submit({"produto": "a"}), b.submit({"produto": "b"}))
+
+    assert asyncio.run(main()) == ["R$ a", "R$ b"]
+    assert posts == [[{"produto": "a"}, {"produto": "b"}]]
+
+
+def test_batcher_flush_por_tempo(monkeypatch):
+    posts = []
+
+    async def fake_post(path, payload):
+        posts.append(payload["itens"])
+        return {"itens": ["ok"] * len(payload["itens"])}
+
+    monkeypatch.setattr(app, "post_n8n", fake_post)
+
+    async def main():
+        b = app.AsyncBatcher("preco-lote", window_s=0.01, max_batch=32)
+        return await asyncio.gather(*(b.submit({"i": i}) for i in range(3)))
+
+    assert asyncio.run(main()) == ["ok", "ok", "ok"]
+    assert len(posts) == 1 and len(posts[0]) == 3
+
+
+def test_batcher_resposta_de_tamanho_errado_falha_todos(monkeypatch):
+    async def fake_post(path, payload):
+        return ["só um"]
+
+    monkeypatch.setattr(app, "post_n8n", fake_post)
+
+    async def main():
+        b = app.AsyncBatcher("preco-lote", window_s=0.01)
+        return await asyncio.gather(*(b.submit({"i": i}) for i in range(3)), return_exceptions=True)
+
+    resultados = asyncio.run(main())
+    assert len(resultados) == 3
+    assert all(isinstance(r, HTTPException) and r.status_code == 502 for r in resultados)
+
+
+# ----------------------------
+# SemanticCache
+# ----------------------------
+def _vec(*xs):
+    v = np.asarray(xs, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+def test_semantic_cache_ttl_no_lookup(monkeypatch):
+    agora = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: agora[0])
+    cache = app.SemanticCache(None, threshold=0.9, ttl_s=10)
+
+    cache.add("aliviozon", _vec(1, 0), "R$ 97,00")
+    assert cache.lookup("aliviozon", _vec(1, 0.01)) == "R$ 97,00"
+    assert cache.lookup("aliviozon", _vec(0, 1)) is None  # pergunta diferente
+    assert cache.lookup("outro", _vec(1, 0)) is None  # outro produto
+
+    agora[0] += 11
+    assert cache.lookup("aliviozon", _vec(1, 0)) is None
+
+
+def test_semantic_cache_ttl_no_add(monkeypatch):
+    agora = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: agora[0])
+    cache = app.SemanticCache(None, threshold=0.9, ttl_s=10)
+
+    cache.add("aliviozon", _vec(1, 0), "antigo")
+    agora[0] += 11
+    cache.add("aliviozon", _vec(0, 1), "novo")  # descarta o vencido
+
+    assert cache._texts["aliviozon"] == ["novo"]
+    assert cache._vecs["aliviozon"].shape[0] == 1
+    assert cache.lookup("aliviozon", _vec(0, 1)) == "novo"
+
+
+# ----------------------------
+# Mensagens triviais
+# ----------------------------
+@pytest.mark.parametrize(
+    "mensagem, grupo",
+    [("oi", "saudacao"), ("Oiee!!", "saudacao"), (" Bom dia ", "saudacao"), ("olá", "saudacao"),
+     ("obrigada", "agradecimento"), ("Valeu!", "agradecimento")],
+)
+def test_intent_re_reconhece(mensagem, grupo):
+    m = app.INTENT_RE.match(mensagem)
+    assert m is not None and m.lastgroup == grupo
+
+
+@pytest.mark.parametrize(
+    "mensagem",
+    ["oi, quanto custa?", "bom dia, tem desconto?", "ok", "beleza", "obrigado, mas e o frete?", "oito"],
+)
+def test_intent_re_ignora(mensagem):
+    assert app.canned_reply(mensagem) is None
+
+
+# ----------------------------
+# n8n_text
+# ----------------------------
+def test_n8n_text_chave_de_texto():
+    assert app.n8n_text({"status": "ok", "texto": "R$ 97,00"}) == "R$ 97,00"
+    assert app.n8n_text("direto") == "direto"
+
+
+def test_n8n_text_sem_texto_mantem_o_resto():
+    assert app.n8n_text({"preco": "R$ 97,00", "status": "ok"}) == '{"status":"ok","preco":"R$ 97,00"}'
+
+
+def test_n8n_text_trunca_e_aceita_int_grande():
+    assert len(app.n8n_text({"status": "ok", "blob": "x" * 5000})) == app.N8N_PASSTHROUGH_MAX
+    assert app.n8n_text([2**70]) == f"[{2**70}]"
+
+
+# ----------------------------
+# run_agent
+# ----------------------------
+class FakeLLM:
+    def __init__(self, *turnos):
+        self.turnos = list(turnos)
+        self.chamadas = []
+
+    async def ainvoke(self, messages, config=None):
+        self.chamadas.append(list(messages))
+        return self.turnos.pop(0)
+
+
+def _call(name, id_, **args):
+    return {"name": name, "args": args, "id": id_, "type": "tool_call"}
+
+
+@pytest.fixture
+def n8n(monkeypatch):
+    chamadas = []
+
+    async def fake_call(path, payload):
+        chamadas.append((path, payload))
+        return "R$ 97,00" if path == "preco" else "enviado"
+
+    monkeypatch.setattr(app, "call_n8n", fake_call)
+    return chamadas
+
+
+def test_run_agent_preco_depois_envio(monkeypatch, n8n):
+    llm = FakeLLM(
+        AIMessage("", tool_calls=[_call("preco", "1")]),
+        AIMessage("", tool_calls=[_call("enviar_msg", "2", texto="Sai por R$ 97,00")]),
+    )
+    monkeypatch.setattr(app, "llm_tools", llm)
+
+    texto, enviado = asyncio.run(app.run_agent("quanto custa?", {"lead_id": "42", "contexto": {}}, {}))
+
+    assert (texto, enviado) == ("Sai por R$ 97,00", True)
+    assert [p for p, _ in n8n] == ["preco", "enviarmsg"]
+    assert n8n[1][1]["lead_id"] == "42"  # injetado, não veio do LLM
+
+
+def test_run_agent_envio_junto_com_preco_nao_envia(monkeypatch, n8n):
+    llm = FakeLLM(
+        AIMessage("", tool_calls=[_call("preco", "1"), _call("enviar_msg", "2", texto="chute")]),
+        AIMessage("", tool_calls=[_call("enviar_msg", "3", texto="Sai por R$ 97,00")]),
+    )
+    monkeypatch.setattr(app, "llm_tools", llm)
+
+    texto, enviado = asyncio.run(app.run_agent("quanto custa?", {"lead_id": "42"}, {}))
+
+    assert (texto, enviado) == ("Sai por R$ 97,00", True)
+    assert [a.get("texto") for p, a in n8n if p == "enviarmsg"] == ["Sai por R$ 97,00"]
+    respostas = [m for m in llm.chamadas[1] if isinstance(m, ToolMessage)]
+    assert [m.tool_call_id for m in respostas] == ["1", "2"]
+
+
+def test_run_agent_erro_de_ferramenta_volta_ao_modelo(monkeypatch):
+    async def fake_call(path, payload):
+        raise HTTPException(status_code=502, detail="n8n fora")
+
+    monkeypatch.setattr(app, "call_n8n", fake_call)
+    llm = FakeLLM(
+        AIMessage("", tool_calls=[_call("preco", "1")]),
+        AIMessage("Vou confirmar o valor e já te retorno."),
+    )
+    monkeypatch.setattr(app, "llm_tools", llm)
+
+    texto, enviado = asyncio.run(app.run_agent("quanto custa?", {"lead_id": "42"}, {}))
+
+    assert (texto, enviado) == ("Vou confirmar o valor e já te retorno.", False)
+    erro = llm.chamadas[1][-1]
+    assert isinstance(erro, ToolMessage) and erro.status == "error"